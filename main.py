@@ -106,8 +106,10 @@ def interpret(cmd, arguments, parts, shorthands, outdir):
             part = check_valid_part(arguments[0], parts, shorthands)
             if part is not None:
                 print('-'*10)
-                print(utils.tree_folder(part.root))
-                print(utils.tree_folder(part.lost))
+                for line in utils.tree_folder_lines(part.root):
+                    print(line)
+                for line in utils.tree_folder_lines(part.lost):
+                    print(line)
                 print('-'*10)
     elif cmd == 'bodyfile':
         if len(arguments) != 2:
@@ -115,16 +117,16 @@ def interpret(cmd, arguments, parts, shorthands, outdir):
         else:
             part = check_valid_part(arguments[0], parts, shorthands)
             if part is not None:
-                contents = [
+                contents = itertools.chain([
                     '# ---' + repr(part) + '---',
                     '# Full paths'
-                ] + utils.bodyfile_folder(part.root) + [
+                ], utils.bodyfile_folder(part.root), [
                     '# \n# Orphaned files'
-                ] + utils.bodyfile_folder(part.lost)
+                ], utils.bodyfile_folder(part.lost))
                 fname = os.path.join(outdir, arguments[1])
                 try:
                     with codecs.open(fname, 'w', encoding='utf8') as outfile:
-                        outfile.write('\n'.join(contents))
+                        utils.write_lines(outfile, contents)
                         print('Saved body file to %s' % fname)
                 except IOError:
                     print('Cannot open file %s for output!' % fname)
@@ -138,9 +140,7 @@ def interpret(cmd, arguments, parts, shorthands, outdir):
                 fname = os.path.join(outdir, arguments[1])
                 try:
                     with codecs.open(fname, 'w', encoding='utf8') as outfile:
-                        outfile.write(
-                            '\n'.join(contents)
-                        )
+                        utils.write_lines(outfile, contents)
                         print('Saved CSV file to %s' % fname)
                 except IOError:
                     print('Cannot open file %s for output!' % fname)
@@ -286,10 +286,14 @@ def main():
         '-o', '--outputdir', type=str, help='directory for restored contents'
         ' and output files'
     )
+    parser.add_argument(
+        '--direct-io', action='store_true',
+        help='read the image bypassing the page cache (O_DIRECT)'
+    )
     args = parser.parse_args()
 
     try:
-        image = open(args.path, 'rb')
+        image = utils.open_image(args.path, args.direct_io)
     except IOError:
         logging.error('Unable to open image file!')
         exit(1)
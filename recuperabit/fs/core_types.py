@@ -49,6 +49,7 @@ class File(object):
         }
         self.children = set()
         self.children_names = set()     # Avoid name clashes breaking restore
+        self._sorted_children = None    # Built when first needed
         self.offset = None  # Offset from beginning of disk
 
     def set_parent(self, parent):
@@ -89,6 +90,17 @@ class File(object):
             logging.warning(u'Renamed {} from {}'.format(node, original_name))
         self.children.add(node)
         self.children_names.add(node.name)
+        self._sorted_children = None
+
+    def sorted_children(self):
+        """Return the children ordered by name.
+
+        The list is shared by all the callers until a new child is added."""
+        if self._sorted_children is None:
+            self._sorted_children = sorted(
+                self.children, key=lambda node: node.name
+            )
+        return self._sorted_children
 
     def full_path(self, part):
         """Return the full path of this file."""
@@ -255,6 +267,20 @@ class DiskScanner(object):
         """Feed a new sector."""
         raise NotImplementedError
 
+    def feed_bulk(self, first, buffer):
+        """Feed consecutive sectors, the first one has the given index.
+
+        Return a list of tuples (index, result) for the sectors in which
+        something was found. Scanners can override this method to skip
+        uninteresting sectors quickly."""
+        found = []
+        for position in range(0, len(buffer), sector_size):
+            index = first + position // sector_size
+            res = self.feed(index, buffer[position:position+sector_size])
+            if res is not None:
+                found.append((index, res))
+        return found
+
     def get_partitions(self):
         """Get a list of the found partitions."""
         raise NotImplementedError
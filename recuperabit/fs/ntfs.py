@@ -22,8 +22,16 @@ including MFT entries and directory indexes."""
 # along with RecuperaBit. If not, see <http://www.gnu.org/licenses/>.
 
 
+import functools
+import gc
+import itertools
 import logging
-from collections import Counter
+import multiprocessing
+import os
+import struct
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from .constants import max_sectors, sector_size
 from .core_types import DiskScanner, File, Partition
@@ -47,6 +55,13 @@ multiple_attributes = set([
 # Size of records in sectors
 FILE_size = 2
 INDX_size = 8
+# Type and length of an attribute header
+attr_start = struct.Struct('<II')
+
+# Use multiple processes to parse at least this amount of records
+parallel_threshold = 4096
+# Amount of records parsed by a worker process at a time
+parallel_chunk = 1024
 
 
 def best_name(entries):
@@ -58,11 +73,14 @@ def best_name(entries):
     if len(entries) == 0:
         return None
 
-    entries.sort()
-    if entries[-1][0] == 3:
-        name = entries[-1][1]
-    else:
+    if len(entries) == 1:
         name = entries[0][1]
+    else:
+        best = max(entries)
+        if best[0] == 3:
+            name = best[1]
+        else:
+            name = min(entries)[1]
     return name if len(name) else None
 
 
@@ -95,17 +113,34 @@ def parse_mft_attr(attr):
 
 
 def _apply_fixup_values(header, entry):
-    """Apply the fixup values to FILE and INDX records."""
+    """Apply the fixup values to FILE and INDX records.
+
+    Return False without changing the record if the fixup array does not
+    fit inside it."""
     offset = header['off_fixup']
-    for i in range(1, header['n_entries']):
+    n_entries = header['n_entries']
+    if offset is None or n_entries is None:
+        return False
+    if (offset + 2*n_entries > len(entry) or
+            sector_size * (n_entries-1) > len(entry)):
+        return False
+    for i in range(1, n_entries):
         pos = sector_size * i
         entry[pos-2:pos] = entry[offset + 2*i:offset + 2*(i+1)]
+    return True
 
 
 def _attributes_reader(entry, offset):
     """Read every attribute."""
     attributes = {}
     while offset < len(entry) - 16:
+        # Skip unknown attributes without parsing them
+        attr_type, length = attr_start.unpack_from(entry, offset)
+        if attr_type not in attr_names:
+            if length == 0:
+                break
+            offset = offset + length
+            continue
         try:
             attr, name = parse_mft_attr(entry[offset:])
         except TypeError:
@@ -146,7 +181,9 @@ def parse_file_record(entry):
     if header['off_fixup'] < 48:
         header['record_n'] = None
 
-    _apply_fixup_values(header, entry)
+    if not _apply_fixup_values(header, entry):
+        header['valid'] = False
+        return header
 
     attributes = _attributes_reader(entry, header['off_first'])
     header['valid'] = True
@@ -158,9 +195,12 @@ def parse_indx_record(entry):
     """Parse the contents of a INDX record (directory index)."""
     header = unpack(entry, indx_fmt)
 
-    _apply_fixup_values(header, entry)
+    if not _apply_fixup_values(header, entry):
+        header['entries'] = []
+        header['valid'] = False
+        return header
 
-    node_data = unpack(entry[24:], indx_header_fmt)
+    node_data = unpack(entry, indx_header_fmt, 24)
     node_data['off_start_list'] += 24
     node_data['off_end_list'] += 24
     node_data['off_end_buffer'] += 24
@@ -169,12 +209,11 @@ def parse_indx_record(entry):
     offset = header['off_start_list']
     entries = []
     while offset < header['off_end_list']:
-        entry_data = unpack(entry[offset:], indx_dir_entry_fmt)
+        entry_data = unpack(entry, indx_dir_entry_fmt, offset)
         if entry_data['content_length']:
             try:
                 file_name = unpack(
-                    entry[offset + 16:],
-                    attr_types_fmt['$FILE_NAME']
+                    entry, attr_types_fmt['$FILE_NAME'], offset + 16
                 )
             except (UnicodeDecodeError, TypeError):  # Invalid file name or invalid name length
                 break
@@ -200,6 +239,21 @@ def parse_indx_record(entry):
     return header
 
 
+@functools.lru_cache(maxsize=4096)
+def _read_record(image, position):
+    """Read and parse a MFT entry, caching the result.
+
+    Entries referenced by $ATTRIBUTE_LIST and the first entries of each MFT
+    are read again during several steps of the reconstruction. The cache is
+    keyed on the image and emptied by each new NTFSScanner.
+
+    The returned structure is shared between all the callers: it must never
+    be modified, neither at the top level nor in its attributes. Callers
+    which need to change it work on a copy, see _integrated_copy."""
+    dump = sectors(image, position, FILE_size)
+    return parse_file_record(dump)
+
+
 def _integrate_attribute_list(parsed, part, image):
     """Integrate missing attributes in the parsed MTF entry."""
     base_record = parsed['record_n']
@@ -245,8 +299,7 @@ def _integrate_attribute_list(parsed, part, image):
         # Read contents of child entries
         for index in entries_by_type[num]:
             real_pos = mft_pos + index * FILE_size
-            dump = sectors(image, real_pos, FILE_size)
-            child_parsed = parse_file_record(dump)
+            child_parsed = _read_record(image, real_pos)
             if 'attributes' not in child_parsed:
                 continue
             # Update the main entry (parsed)
@@ -254,14 +307,210 @@ def _integrate_attribute_list(parsed, part, image):
                 child_attrs = child_parsed['attributes']
                 for name in child_attrs:
                     if name in multiple_attributes:
+                        # Avoid extending the (cached) lists of the child
                         try:
-                            attrs[name] += child_attrs[name]
+                            attrs[name] = attrs[name] + child_attrs[name]
                         except KeyError:
-                            attrs[name] = child_attrs[name]
+                            attrs[name] = list(child_attrs[name])
                     else:
                         attrs[name] = child_attrs[name]
 
 
+def _integrated_copy(parsed, part, image):
+    """Return a copy of parsed with the attributes from $ATTRIBUTE_LIST.
+
+    The original entry, which may be cached or shared, is left untouched."""
+    attrs = dict(parsed['attributes'])
+    attrs['$ATTRIBUTE_LIST'] = dict(attrs['$ATTRIBUTE_LIST'])
+    parsed = dict(parsed, attributes=attrs)
+    _integrate_attribute_list(parsed, part, image)
+    return parsed
+
+
+def _data_size(datas, ads):
+    """Return the size of the $DATA attribute with the given name."""
+    for attr in datas:
+        if attr['name'] == ads:
+            if 'real_size' in attr:
+                return attr['real_size']
+            elif not attr['non_resident']:
+                return attr['content_size']
+            break
+    return None
+
+
+def _mirror_position(image, part):
+    """Infer the position of the MFT mirror from the $MFTMirr entry.
+
+    Return None if it cannot be determined."""
+    entry = part.get(1)     # $MFTMirr
+    spc = part.sec_per_clus
+    if entry is None or spc is None:
+        return None
+    mirror = _read_record(image, entry.offset)
+    if not mirror['valid']:
+        return None
+    datas = mirror.get('attributes', {}).get('$DATA')
+    if datas is None or len(datas) != 1 or not datas[0]['non_resident']:
+        return None
+    runlist = datas[0].get('runlist')
+    if not runlist or 'offset' not in runlist[0]:
+        return None
+    return runlist[0]['offset'] * spc + part.offset
+
+
+def _found_indexes(part):
+    """Return the set of indexes of the files in part which are not ghosts."""
+    return set(i for i, node in part.files.items() if not node.is_ghost)
+
+
+def _parse_file(dump):
+    """Parse a dump containing a FILE record.
+
+    Return None if the record cannot be assigned to a partition."""
+    parsed = parse_file_record(dump)
+    attrs = parsed.get('attributes', {})
+    if not parsed['valid'] or '$FILE_NAME' not in attrs:
+        return None
+    # TODO [Future] handle files for which there is no record_number
+    if parsed['record_n'] is None:
+        return None
+    return parsed
+
+
+def _parse_indx(dump):
+    """Parse a dump containing an INDX record and summarize it.
+
+    Return None if the record is not valid."""
+    parsed = parse_indx_record(dump)
+    if not parsed['valid']:
+        return None
+
+    entries = parsed['entries']
+    # The parent is the most referred entry (first one on ties)
+    referred = {}
+    for el in entries:
+        parent = el['file_info']['parent_entry']
+        referred[parent] = referred.get(parent, 0) + 1
+    record_n = max(referred, key=referred.get)
+    # There can be millions of INDX records, so children are kept in a
+    # compact tuple.
+    return {
+        'parent': record_n,
+        'children': tuple(set(el['record_n'] for el in entries))
+    }
+
+
+def _read_records(image, positions, size):
+    """Read the records of the given size (in sectors) at some positions.
+
+    Adjacent records are read at once and then sliced. If reading a group
+    fails, its records are read one by one. Return a dictionary of dumps."""
+    dumps = {}
+    ordered = sorted(positions)
+    length = size * sector_size
+    start = 0
+    while start < len(ordered):
+        end = start + 1
+        while end < len(ordered) and ordered[end] == ordered[end-1] + size:
+            end += 1
+        group = ordered[start:end]
+        run = None
+        if len(group) > 1:
+            run = sectors(image, group[0], len(group) * size, fill=False)
+        if run is None:
+            for position in group:
+                dumps[position] = sectors(image, position, size)
+        else:
+            for i, position in enumerate(group):
+                dumps[position] = run[i*length:(i+1)*length]
+        start = end
+    return dumps
+
+
+def _parse_positions(image, positions, parser, size):
+    """Apply parser to the records at some positions, keeping their order."""
+    dumps = _read_records(image, positions, size)
+    return [(position, parser(dumps[position])) for position in positions]
+
+
+# Image opened by each worker process of _parse_records
+_worker_image = None
+
+
+def _init_worker(path):
+    """Open the image in a worker process."""
+    global _worker_image
+    _worker_image = open(path, 'rb')
+
+
+def _parse_chunk(parser, size, positions):
+    """Apply parser to some positions inside a worker process."""
+    return _parse_positions(_worker_image, positions, parser, size)
+
+
+def _parse_records(image, positions, parser, size):
+    """Apply parser to the records of the given size found at some positions.
+
+    Yield tuples (position, result) in the same order of positions. Records
+    are read in chunks. When there are many records and the image can be
+    opened again by path, the work is split among multiple processes."""
+    positions = list(positions)
+    path = getattr(image, 'name', None)
+    workers = os.cpu_count() or 1
+    done = 0
+    if (workers > 1 and len(positions) >= parallel_threshold and
+            isinstance(path, str) and os.path.exists(path)):
+        chunks = (
+            positions[i:i+parallel_chunk]
+            for i in range(0, len(positions), parallel_chunk)
+        )
+        try:
+            with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                     initargs=(path,)) as executor:
+                # Keep a bounded amount of results in flight
+                pending = deque(
+                    executor.submit(_parse_chunk, parser, size, chunk)
+                    for chunk in itertools.islice(chunks, 2 * workers)
+                )
+                while pending:
+                    results = pending.popleft().result()
+                    for chunk in itertools.islice(chunks, 1):
+                        pending.append(
+                            executor.submit(_parse_chunk, parser, size, chunk)
+                        )
+                    for result in results:
+                        yield result
+                        done += 1
+        except (OSError, BrokenProcessPool) as err:
+            logging.warning(
+                'Parallel parsing failed (%s), continuing in a single '
+                'process', err
+            )
+    for i in range(done, len(positions), parallel_chunk):
+        chunk = positions[i:i+parallel_chunk]
+        for result in _parse_positions(image, chunk, parser, size):
+            yield result
+
+
+# Scanner and partitions inherited by the processes of finalize_partitions
+_worker_partitions = None
+
+
+def _init_finalize_worker(path):
+    """Open the image again in a forked worker process."""
+    scanner, _ = _worker_partitions
+    scanner.image = open(path, 'rb')
+
+
+def _finalize_in_worker(address):
+    """Finalize the partition at address inside a worker process.
+
+    Return the files which were added, see finalize_reconstruction."""
+    scanner, partitioned_files = _worker_partitions
+    return scanner.finalize_reconstruction(partitioned_files[address])
+
+
 class NTFSFile(File):
     """NTFS File."""
     def __init__(self, parsed, offset, is_ghost=False, ads=''):
@@ -271,28 +520,19 @@ class NTFSFile(File):
             index = str(index) + ads_suffix
         attrs = parsed['attributes']
         filenames = attrs['$FILE_NAME']
-        datas = attrs.get('$DATA', [])
-
-        size = None
-        for attr in datas:
-            if attr['name'] == ads:
-                if 'real_size' in attr:
-                    size = attr['real_size']
-                elif not attr['non_resident']:
-                    size = attr['content_size']
-                break
+        size = _data_size(attrs.get('$DATA', []), ads)
 
-        filtered = [
-            f for f in filenames if 'content' in f and
-            f['content'] is not None and
-            'name_length' in f['content'] and
-            f['content']['name_length'] > 0 and
-            f['content']['name'] is not None
-        ]
-        name = best_name([
-            (f['content']['namespace'], f['content']['name'] + ads_suffix)
-            for f in filtered
-        ])
+        filtered = []
+        entries = []
+        for f in filenames:
+            content = f.get('content')
+            if (content is not None and
+                    content.get('name_length', 0) > 0 and
+                    content['name'] is not None):
+                filtered.append(content)
+                entries.append((content['namespace'],
+                                content['name'] + ads_suffix))
+        name = best_name(entries)
         hasname = name is not None
 
         if not hasname:
@@ -308,19 +548,40 @@ class NTFSFile(File):
 
         # Additional attributes
         if hasname:
-            first = filtered[0]['content']
+            first = filtered[0]
             parent_id = first['parent_entry']
             File.set_parent(self, parent_id)
             File.set_offset(self, offset)
-            time_attribute = std_info or filtered[0]
-        if time_attribute and 'content' in time_attribute:
+            if std_info is not None:
+                time_attribute = std_info.get('content')
+            else:
+                time_attribute = first
+        if time_attribute:
             File.set_mac(
-                self, time_attribute['content']['modification_time'],
-                time_attribute['content']['access_time'],
-                time_attribute['content']['creation_time'],
+                self, time_attribute['modification_time'],
+                time_attribute['access_time'],
+                time_attribute['creation_time'],
             )
         self.ads = ads
 
+    @classmethod
+    def ads_clone(cls, base, parsed, ads):
+        """Create the file of an ADS, reusing the values of the base file.
+
+        This avoids parsing the same MFT entry again for every named $DATA
+        attribute."""
+        clone = cls.__new__(cls)
+        size = _data_size(parsed['attributes'].get('$DATA', []), ads)
+        File.__init__(
+            clone, '%s:%s' % (base.index, ads), base.name + ':' + ads, size,
+            False, base.is_deleted, base.is_ghost
+        )
+        clone.set_parent(base.parent)
+        clone.set_offset(base.offset)
+        clone.set_mac(*base.get_mac())
+        clone.ads = ads
+        return clone
+
     @staticmethod
     def _padded_bytes(image, offset, size):
         dump = sectors(image, offset, size, 1)
@@ -475,11 +736,12 @@ class NTFSScanner(DiskScanner):
         self.indx_list = None
         self.found_boot = []
         self.found_spc = []
+        _read_record.cache_clear()
 
     def feed(self, index, sector):
         """Feed a new sector."""
         # check boot sector
-        if sector.endswith(b'\x55\xAA') and b'NTFS' in sector[:8]:
+        if sector.endswith(b'\x55\xAA') and sector.find(b'NTFS', 0, 8) >= 0:
             self.found_boot.append(index)
             return 'NTFS boot sector'
 
@@ -493,9 +755,42 @@ class NTFSScanner(DiskScanner):
             self.found_indx.add(index)
             return 'NTFS index record'
 
+    def feed_bulk(self, first, buffer):
+        """Feed consecutive sectors, the first one has the given index."""
+        whole = len(buffer) // sector_size * sector_size
+        # Only sectors starting with F, B or I or having 0x55 before their
+        # last byte can be records or boot sectors
+        heads = buffer[0:whole:sector_size]
+        tails = buffer[sector_size-2:whole:sector_size]
+        candidates = set()
+        for markers, table in ((b'FBI', heads), (b'\x55', tails)):
+            for marker in markers:
+                position = table.find(marker)
+                while position >= 0:
+                    candidates.add(position)
+                    position = table.find(marker, position + 1)
+        found = []
+        for position in sorted(candidates):
+            start = position * sector_size
+            res = self.feed(
+                first + position, buffer[start:start+sector_size]
+            )
+            if res is not None:
+                found.append((first + position, res))
+        # A short sector at the end of the image
+        if whole < len(buffer):
+            index = first + whole // sector_size
+            res = self.feed(index, buffer[whole:])
+            if res is not None:
+                found.append((index, res))
+        return found
+
     @staticmethod
     def add_indx_entries(entries, part):
-        """Insert new ghost files which were not already found."""
+        """Insert new ghost files which were not already found.
+
+        Return the list of inserted files."""
+        added = []
         for rec in entries:
             if (rec['record_n'] not in part.files and
                     rec['$FILE_NAME'] is not None):
@@ -510,7 +805,10 @@ class NTFSScanner(DiskScanner):
                 by looking at the number of children, after the
                 reconstruction."""
                 rec['flags'] = 0x1
-                part.add_file(NTFSFile(rec, None, is_ghost=True))
+                node = NTFSFile(rec, None, is_ghost=True)
+                part.add_file(node)
+                added.append(node)
+        return added
 
     def add_from_indx_root(self, parsed, part):
         """Add ghost entries to part from INDEX_ROOT attributes in parsed."""
@@ -528,14 +826,20 @@ class NTFSScanner(DiskScanner):
         counter.update(2**i for i in range(8))
         return [i for i, _ in counter.most_common()]
 
+    def reviewed_records(self, part):
+        """Return the saved records of the files in part, once per offset."""
+        review = self.parsed_file_review
+        offsets = dict.fromkeys(
+            node.offset for node in part.files.values()
+            if node.offset in review
+        )
+        return [(offset, review[offset]) for offset in offsets]
+
     def find_boundary(self, part, mft_address, multipliers):
         """Determine the starting sector of a partition with INDX records."""
         nodes = (
-            self.parsed_file_review[node.offset]
-            for node in part.files.values()
-            if node.offset in self.parsed_file_review and
-            '$INDEX_ALLOCATION' in
-            self.parsed_file_review[node.offset]['attributes']
+            parsed for _, parsed in self.reviewed_records(part)
+            if '$INDEX_ALLOCATION' in parsed['attributes']
         )
 
         text_list = self.indx_list
@@ -571,7 +875,7 @@ class NTFSScanner(DiskScanner):
             if len(normalized) < min_support:
                 continue
 
-            pattern_list = SparseList(normalized)
+            pattern_list = SparseList.from_dict_view(normalized)
             solution = approximate_matching(
                 text_list, pattern_list, mft_address + delta, k=min_support
             )
@@ -597,7 +901,7 @@ class NTFSScanner(DiskScanner):
         """Add ghost entries to part from INDEX_ALLOCATION attributes in parsed.
 
         This procedure requires that the beginning of the partition has already
-        been discovered."""
+        been discovered. Return the list of inserted files."""
         read_again = set()
         for attr in parsed['attributes']['$INDEX_ALLOCATION']:
             clusters_pos = 0
@@ -619,11 +923,13 @@ class NTFSScanner(DiskScanner):
                         if len(discovered):
                             read_again.add(real_pos)
 
+        added = []
         img = DiskScanner.get_image(self)
         for position in read_again:
             dump = sectors(img, position, INDX_size)
             entries = parse_indx_record(dump)['entries']
-            self.add_indx_entries(entries, part)
+            added += self.add_indx_entries(entries, part)
+        return added
 
     def add_from_attribute_list(self, parsed, part, offset):
         """Add additional entries to part from attributes in ATTRIBUTE_LIST.
@@ -631,17 +937,19 @@ class NTFSScanner(DiskScanner):
         Files with many attributes may have additional attributes not in the
         MFT entry. When this happens, it is necessary to find the other
         attributes. They may contain additional information, such as $DATA
-        attributes for ADS. This procedure requires that the beginning of the
-        partition has already been discovered."""
-        image = DiskScanner.get_image(self)
-        _integrate_attribute_list(parsed, part, image)
-
+        attributes for ADS. The other attributes must have already been
+        integrated in parsed, see _integrated_copy. Return the list of
+        inserted files."""
+        added = []
         attrs = parsed['attributes']
         if '$DATA' in attrs:
             for attribute in attrs['$DATA']:
                 ads_name = attribute['name']
                 if ads_name and len(ads_name):
-                    part.add_file(NTFSFile(parsed, offset, ads=ads_name))
+                    node = NTFSFile(parsed, offset, ads=ads_name)
+                    part.add_file(node)
+                    added.append(node)
+        return added
 
     def add_from_mft_mirror(self, part):
         """Fix the first file records using the MFT mirror."""
@@ -654,8 +962,7 @@ class NTFSScanner(DiskScanner):
             node = part.get(i)
             if node is None or node.is_ghost:
                 position = mirrpos + i * FILE_size
-                dump = sectors(img, position, FILE_size)
-                parsed = parse_file_record(dump)
+                parsed = _read_record(img, position)
                 if parsed['valid'] and '$FILE_NAME' in parsed['attributes']:
                     node = NTFSFile(parsed, position)
                     part.add_file(node)
@@ -668,30 +975,69 @@ class NTFSScanner(DiskScanner):
         """Finish information gathering from a file.
 
         This procedure requires that the beginning of the
-        partition has already been discovered."""
-        logging.info('Adding extra attributes from $ATTRIBUTE_LIST')
-        # Select elements with many attributes
-        many_attributes_it = (
-            node for node in list(part.files.values())
-            if node.offset in self.parsed_file_review and
-            '$ATTRIBUTE_LIST' in
-            self.parsed_file_review[node.offset]['attributes']
+        partition has already been discovered. Files are only ever added to
+        part, nothing else is modified. Return a dictionary with the added
+        files, so that the same changes can be applied to another copy of
+        the partition."""
+        logging.info(
+            'Adding extra attributes from $ATTRIBUTE_LIST and ghost entries '
+            'from $INDEX_ALLOCATION'
         )
-        for node in many_attributes_it:
-            parsed = self.parsed_file_review[node.offset]
-            self.add_from_attribute_list(parsed, part, node.offset)
-
-        logging.info('Adding ghost entries from $INDEX_ALLOCATION')
-        # Select only elements with $INDEX_ALLOCATION
-        allocation_it = (
-            node for node in list(part.files.values())
-            if node.offset in self.parsed_file_review and
-            '$INDEX_ALLOCATION' in
-            self.parsed_file_review[node.offset]['attributes']
-        )
-        for node in allocation_it:
-            parsed = self.parsed_file_review[node.offset]
-            self.add_from_indx_allocation(parsed, part)
+        image = DiskScanner.get_image(self)
+        added = []
+        records = []
+        # Visit each saved record once, even if it has many ADS nodes
+        for offset, parsed in self.reviewed_records(part):
+            if '$ATTRIBUTE_LIST' in parsed['attributes']:
+                # The saved record is left untouched
+                parsed = _integrated_copy(parsed, part, image)
+                added += self.add_from_attribute_list(parsed, part, offset)
+            records.append(parsed)
+        # All the ADS are known before looking for ghost entries
+        for parsed in records:
+            if '$INDEX_ALLOCATION' in parsed['attributes']:
+                added += self.add_from_indx_allocation(parsed, part)
+        return {node.index: node for node in added}
+
+    def finalize_partitions(self, partitioned_files, addresses):
+        """Finish information gathering from the partitions at addresses.
+
+        Partitions are independent, hence they are handled by multiple
+        processes when possible. The files returned by finalize_reconstruction
+        in each worker are then inserted in the partitions of this process.
+        Workers are forked and share the memory of the scanner until they
+        write to it."""
+        global _worker_partitions
+        path = getattr(DiskScanner.get_image(self), 'name', None)
+        workers = min(os.cpu_count() or 1, len(addresses))
+        done = 0
+        if (workers > 1 and isinstance(path, str) and os.path.exists(path)
+                and 'fork' in multiprocessing.get_all_start_methods()):
+            # Workers inherit the state of the scanner by forking
+            _worker_partitions = (self, partitioned_files)
+            # Keep the collector from touching, hence copying, shared pages
+            gc.freeze()
+            try:
+                with ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context('fork'),
+                    initializer=_init_finalize_worker, initargs=(path,)
+                ) as executor:
+                    results = executor.map(_finalize_in_worker, addresses)
+                    for address, files in zip(addresses, results):
+                        part = partitioned_files[address]
+                        for node in files.values():
+                            part.add_file(node)
+                        done += 1
+            except (OSError, BrokenProcessPool) as err:
+                logging.warning(
+                    'Parallel reconstruction failed (%s), continuing in a '
+                    'single process', err
+                )
+            finally:
+                _worker_partitions = None
+                gc.unfreeze()
+        for address in addresses[done:]:
+            self.finalize_reconstruction(partitioned_files[address])
 
     def get_partitions(self):
         """Get a list of the found partitions."""
@@ -699,58 +1045,50 @@ class NTFSScanner(DiskScanner):
         img = DiskScanner.get_image(self)
 
         logging.info('Parsing MFT entries')
-        for position in self.found_file:
-            dump = sectors(img, position, FILE_size)
-            parsed = parse_file_record(dump)
-            attrs = parsed.get('attributes', {})
-            if not parsed['valid'] or '$FILE_NAME' not in attrs:
+        parsed_files = _parse_records(
+            img, self.found_file, _parse_file, FILE_size
+        )
+        for position, parsed in parsed_files:
+            if parsed is None:
                 continue
+            attrs = parsed['attributes']
 
             # Partition files based on corresponding entry 0
-            if parsed['record_n'] is not None:
-                offset = position - parsed['record_n'] * FILE_size
-                try:
-                    part = partitioned_files[offset]
-                except KeyError:
-                    partitioned_files[offset] = NTFSPartition(self, offset)
-                    part = partitioned_files[offset]
-                attributes = parsed['attributes']
-                if '$DATA' in attributes:
-                    for attribute in attributes['$DATA']:
-                        ads_name = attribute['name']
-                        if ads_name:
-                            part.add_file(NTFSFile(parsed, position, ads=ads_name))
-                """Add the file again, just in case the $DATA attributes are
-                missing."""
-                part.add_file(NTFSFile(parsed, position))
-
-                # Handle information deduced from INDX records
-                if '$INDEX_ROOT' in attrs:
-                    self.add_from_indx_root(parsed, part)
-                # Save for later use
-                if '$INDEX_ALLOCATION' in attrs or '$ATTRIBUTE_LIST' in attrs:
-                    self.parsed_file_review[position] = parsed
-            # TODO [Future] handle files for which there is no record_number
+            offset = position - parsed['record_n'] * FILE_size
+            try:
+                part = partitioned_files[offset]
+            except KeyError:
+                partitioned_files[offset] = NTFSPartition(self, offset)
+                part = partitioned_files[offset]
+            node = NTFSFile(parsed, position)
+            if '$DATA' in attrs:
+                for attribute in attrs['$DATA']:
+                    ads_name = attribute['name']
+                    if ads_name:
+                        part.add_file(
+                            NTFSFile.ads_clone(node, parsed, ads_name)
+                        )
+            part.add_file(node)
+
+            # Handle information deduced from INDX records
+            if '$INDEX_ROOT' in attrs:
+                self.add_from_indx_root(parsed, part)
+            # Save for later use
+            if '$INDEX_ALLOCATION' in attrs or '$ATTRIBUTE_LIST' in attrs:
+                self.parsed_file_review[position] = parsed
 
         # Parse INDX records
         logging.info('Parsing INDX records')
-        for position in self.found_indx:
-            dump = sectors(img, position, INDX_size)
-            parsed = parse_indx_record(dump)
-            if not parsed['valid']:
-                continue
-
-            entries = parsed['entries']
-            referred = (el['file_info']['parent_entry'] for el in entries)
-            record_n = Counter(referred).most_common(1)[0][0]
-            # Save references for future access
-            self.parsed_indx[position] = {
-                'parent': record_n,
-                'children': set(el['record_n'] for el in entries)
-            }
+        parsed_indx = _parse_records(
+            img, self.found_indx, _parse_indx, INDX_size
+        )
+        for position, summary in parsed_indx:
+            if summary is not None:
+                # Save references for future access
+                self.parsed_indx[position] = summary
 
         indx_info = self.parsed_indx
-        self.indx_list = SparseList({
+        self.indx_list = SparseList.from_dict_view({
             pos: indx_info[pos]['parent'] for pos in indx_info
         })
 
@@ -786,26 +1124,8 @@ class NTFSScanner(DiskScanner):
             part = partitioned_files[address]
             mirrpos = part.mftmirr_pos
             if mirrpos is None:
-                entry = part.get(1)     # $MFTMirr
-                if entry is None:
-                    continue
-                else:
-                    # Infer MFT mirror position
-                    dump = sectors(img, entry.offset, FILE_size)
-                    mirror = parse_file_record(dump)
-                    if (mirror['valid'] and 'attributes' in mirror and
-                            '$DATA' in mirror['attributes']):
-                        datas = mirror['attributes']['$DATA']
-                        if (len(datas) == 1 and datas[0]['non_resident'] and
-                                'runlist' in datas[0] and
-                                len(datas[0]['runlist']) > 0 and
-                                'offset' in datas[0]['runlist'][0]):
-                            relative = datas[0]['runlist'][0]['offset']
-                            spc = part.sec_per_clus
-                            if spc is None:
-                                continue
-                            mirrpos = relative * spc + part.offset
-                            part.mftmirr_pos = mirrpos
+                mirrpos = _mirror_position(img, part)
+                part.mftmirr_pos = mirrpos
 
             self.add_from_mft_mirror(part)
 
@@ -825,6 +1145,7 @@ class NTFSScanner(DiskScanner):
         # Acquire additional information from $INDEX_ALLOCATION
         logging.info('Finding partition geometry')
         most_likely = self.most_likely_sec_per_clus()
+        to_finalize = []
         for address in partitioned_files:
             part = partitioned_files[address]
             if part.offset is None:
@@ -843,7 +1164,8 @@ class NTFSScanner(DiskScanner):
                     'Finalizing MFT reconstruction of partition at offset %i',
                     offset
                 )
-                self.finalize_reconstruction(part)
+                to_finalize.append(address)
+        self.finalize_partitions(partitioned_files, to_finalize)
 
         # Merge pieces from fragmented MFT
         for address in list(partitioned_files):
@@ -854,13 +1176,13 @@ class NTFSScanner(DiskScanner):
             entry = part.get(0)     # $MFT
             if entry is None or part.sec_per_clus is None:
                 continue
-            dump = sectors(img, entry.offset, FILE_size)
-            parsed = parse_file_record(dump)
+            parsed = _read_record(img, entry.offset)
             if not parsed['valid'] or 'attributes' not in parsed:
                 continue
 
             if '$ATTRIBUTE_LIST' in parsed['attributes']:
-                _integrate_attribute_list(parsed, part, img)
+                # Integrate a copy, the cached entry is shared
+                parsed = _integrated_copy(parsed, part, img)
             attrs = parsed['attributes']
             if '$DATA' not in attrs or len(attrs['$DATA']) < 1:
                 continue
@@ -876,6 +1198,7 @@ class NTFSScanner(DiskScanner):
                 clusters_pos = runlist[0]['offset']
                 spc = part.sec_per_clus
                 size = runlist[0]['length']
+                found = _found_indexes(part)
                 for entry in runlist[1:]:
                     clusters_pos += entry['offset']
                     real_pos = clusters_pos * part.sec_per_clus + part.offset
@@ -883,19 +1206,15 @@ class NTFSScanner(DiskScanner):
                     if position in partitioned_files:
                         piece = partitioned_files[position]
                         if piece.offset is None or piece.offset == part.offset:
-                            conflicts = [
-                                i for i in piece.files if
-                                not piece.files[i].is_ghost and
-                                i in part.files and
-                                not part.files[i].is_ghost
-                            ]
-                            if not len(conflicts):
+                            piece_found = _found_indexes(piece)
+                            if found.isdisjoint(piece_found):
                                 logging.debug(
                                     'Merging partition with MFT offset %d into'
                                     ' %s (fragmented MFT)', piece.mft_pos, part
                                 )
                                 # Merge the partitions
                                 merge(part, piece)
+                                found |= piece_found
                                 # Remove the fragment
                                 partitioned_files.pop(position)
                             else:
@@ -21,43 +21,59 @@
 
 from datetime import datetime, timezone, timedelta
 
-from ..utils import printable, unpack
+from ..utils import precompile, printable, unpack
 
 
 time_start = datetime(1601, 1, 1, tzinfo=timezone.utc)
 
 def printable_name(name):
     """Return a printable name decoded in UTF-16."""
-    decoded = []
-    parts = (name[i:i+2] for i in range(0, len(name), 2))
-    for part in parts:
-        try:
-            decoded.append(part.decode('utf-16'))
-        except UnicodeDecodeError:
-            decoded.append('\x00')
-    joined = ''.join(decoded)
+    # Most attributes are unnamed
+    if not len(name):
+        return ''
+    try:
+        joined = name.decode('utf-16-le')
+    except UnicodeDecodeError:
+        joined = None
+    # Names with broken units, surrogate pairs or byte order marks are
+    # decoded one unit at a time
+    if (joined is None or 2*len(joined) != len(name) or
+            '\ufeff' in joined or '\ufffe' in joined):
+        decoded = []
+        parts = (name[i:i+2] for i in range(0, len(name), 2))
+        for part in parts:
+            try:
+                decoded.append(part.decode('utf-16'))
+            except UnicodeDecodeError:
+                decoded.append('\x00')
+        joined = ''.join(decoded)
     # basic check for false positives
     if '\x00\x00\x00' in joined:
         return None
     return printable(joined, '#')
 
 
-def windows_time(timestamp):
-    """Convert a date-time value from Microsoft filetime to UTC."""
+def filetime(value):
+    """Convert an integer Microsoft filetime to UTC."""
     try:
-        value = int.from_bytes(timestamp, byteorder='little', signed=False)
-        converted = time_start + timedelta(milliseconds = value//10000)
-        return converted
+        return time_start + timedelta(milliseconds=value//10000)
     except (ValueError, OverflowError, OSError):
         return None
 
 
+def windows_time(timestamp):
+    """Convert a date-time value from Microsoft filetime to UTC."""
+    return filetime(
+        int.from_bytes(timestamp, byteorder='little', signed=False)
+    )
+
+
 def index_entries(dump):
     """Interpret the entries of an index."""
     offset = 0
     entries = []
     while offset < len(dump):
-        parsed = unpack(dump[offset:], indx_dir_entry_fmt)
+        parsed = unpack(dump, indx_dir_entry_fmt, offset)
         filename = parsed['$FILE_NAME']
         entry_length = parsed['entry_length']
         valid_length = entry_length > 0
@@ -87,39 +103,35 @@ def index_root_parser(dump):
 def runlist_unpack(runlist):
     """Parse an attribute runlist."""
     pieces = []
-    while len(runlist) and runlist[0] != 0:
-        off_bytes, len_bytes = divmod(runlist[0], 2**4)
-        end = len_bytes + off_bytes
-        decoded = unpack(runlist, [
-            ('length', ('i', 1, len_bytes)),
-            ('offset', ('+i', len_bytes + 1, end))
-        ])
-        if decoded['length'] is None or decoded['offset'] is None:
+    position = 0
+    while position < len(runlist) and runlist[position] != 0:
+        off_bytes, len_bytes = divmod(runlist[position], 2**4)
+        start = position + 1
+        end = start + len_bytes + off_bytes
+        length = runlist[start:start+len_bytes]
+        offset = runlist[start+len_bytes:end]
+        if not len(length) or not len(offset):
             break
-        pieces.append(decoded)
-        runlist = runlist[end+1:]
+        pieces.append({
+            'length': int.from_bytes(length, byteorder='little'),
+            'offset': int.from_bytes(offset, byteorder='little', signed=True)
+        })
+        position = end
     return pieces
 
 
 def attribute_list_parser(dump):
     """Parse entries contained in a $ATTRIBUTE_LIST attribute."""
     content = []
-    while len(dump):
-        decoded = unpack(dump, [
-            ('type', ('i', 0, 3)),
-            ('length', ('i', 4, 5)),
-            ('name_length', ('i', 6, 6)),
-            ('name_off', ('i', 7, 7)),
-            ('start_VCN', ('i', 8, 15)),
-            ('file_ref', ('i', 16, 19)),
-            ('id', ('i', 24, 24))
-        ])
+    offset = 0
+    while offset < len(dump):
+        decoded = unpack(dump, attr_list_entry_fmt, offset)
         length = decoded['length']
         # Check either if the length is 0 or if it is None
         if not length:
             break
         content.append(decoded)
-        dump = dump[length:]
+        offset += length
     return content
 
 
@@ -190,6 +202,16 @@ indx_dir_entry_fmt = [
     # )
 ]
 
+attr_list_entry_fmt = [
+    ('type', ('i', 0, 3)),
+    ('length', ('i', 4, 5)),
+    ('name_length', ('i', 6, 6)),
+    ('name_off', ('i', 7, 7)),
+    ('start_VCN', ('i', 8, 15)),
+    ('file_ref', ('i', 16, 19)),
+    ('id', ('i', 24, 24))
+]
+
 attr_header_fmt = [
     ('type', ('i', 0, 3)),
     ('length', ('i', 4, 7)),
@@ -272,3 +294,12 @@ attr_types_fmt = {
         ('records', (index_root_parser, 16, lambda r: r['record_bytes']))
     ]
 }
+
+for fmt in (
+    entry_fmt, boot_sector_fmt, indx_fmt, indx_header_fmt, indx_dir_entry_fmt,
+    attr_list_entry_fmt, attr_header_fmt, attr_resident_fmt,
+    attr_nonresident_fmt
+):
+    precompile(fmt)
+for fmt in attr_types_fmt.values():
+    precompile(fmt, {windows_time: ('Q', filetime)})
@@ -27,9 +27,18 @@ import os.path
 import sys
 import time
 import types
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from .utils import tiny_repr
 
+# Amount of bytes collected before writing restored contents
+write_block_size = 16 * 2**20
+# Threads writing restored files
+restore_threads = 8
+# Files waiting to be written before the traversal waits for the writers
+restore_pending = 4 * restore_threads
+
 
 class SparseList(object):
     """List which only stores values at some places."""
@@ -37,10 +46,21 @@ class SparseList(object):
         self.keys = []  # This is always kept in order
         self.elements = {}
         self.default = default
+        self.value_counts = None    # Built when first needed
         if data is not None:
             self.keys = sorted(data)
             self.elements.update(data)
 
+    @classmethod
+    def from_dict_view(cls, data, default=None):
+        """Build a SparseList which uses data directly, without copying it.
+
+        The dictionary must not be modified elsewhere afterwards."""
+        sparse = cls(default=default)
+        sparse.keys = sorted(data)
+        sparse.elements = data
+        return sparse
+
     def __len__(self):
         try:
             return self.keys[-1] + 1
@@ -53,15 +73,35 @@ class SparseList(object):
     def __setitem__(self, index, item):
         if item == self.default:
             if index in self.elements:
-                del self.elements[index]
-                del self.keys[bisect.bisect_left(self.keys, index)]
+                self._forget(self.elements.pop(index))
+                if self.keys[-1] == index:
+                    self.keys.pop()
+                else:
+                    del self.keys[bisect.bisect_left(self.keys, index)]
         else:
             if index not in self.elements:
-                bisect.insort(self.keys, index)
+                # Keys are often added in increasing order
+                if not len(self.keys) or index > self.keys[-1]:
+                    self.keys.append(index)
+                else:
+                    bisect.insort(self.keys, index)
+            else:
+                self._forget(self.elements[index])
             self.elements[index] = item
+            if self.value_counts is not None:
+                self.value_counts[item] += 1
 
     def __contains__(self, element):
-        return element in self.elements.values()
+        if self.value_counts is None:
+            try:
+                self.value_counts = Counter(self.elements.values())
+            except TypeError:
+                # Unhashable values
+                return element in self.elements.values()
+        try:
+            return element in self.value_counts
+        except TypeError:
+            return element in self.elements.values()
 
     def __iter__(self):
         return self.keys.__iter__()
@@ -103,22 +143,30 @@ class SparseList(object):
         for k in self.keys:
             yield self.elements[k]
 
+    def _forget(self, item):
+        """Update the value counts after removing an item."""
+        if self.value_counts is not None:
+            self.value_counts[item] -= 1
+            if self.value_counts[item] <= 0:
+                del self.value_counts[item]
+
     def wipe_interval(self, bottom, top):
         """Remove elements between bottom and top."""
-        new_keys = set()
         if bottom > top:
-            for k in self.keys:
-                if top <= k < bottom:
-                    new_keys.add(k)
-                else:
-                    del self.elements[k]
+            # Keep only the keys in [top, bottom)
+            low = bisect.bisect_left(self.keys, top)
+            high = bisect.bisect_left(self.keys, bottom)
+            for k in self.keys[:low]:
+                self._forget(self.elements.pop(k))
+            for k in self.keys[high:]:
+                self._forget(self.elements.pop(k))
+            self.keys = self.keys[low:high]
         else:
-            for k in self.keys:
-                if bottom <= k < top:
-                    del self.elements[k]
-                else:
-                    new_keys.add(k)
-        self.keys = sorted(new_keys)
+            low = bisect.bisect_left(self.keys, bottom)
+            high = bisect.bisect_left(self.keys, top)
+            for k in self.keys[low:high]:
+                self._forget(self.elements.pop(k))
+            del self.keys[low:high]
 
 
 def preprocess_pattern(pattern):
@@ -134,7 +182,33 @@ def preprocess_pattern(pattern):
             result[name] = [length-k-1]
         elif name != result[name][-1]:
             result[name].append(length-k-1)
-    return result
+    # Tuples are faster to iterate in the matching loop
+    return {name: tuple(offsets) for name, offsets in result.items()}
+
+
+def wipe_counts(count, bottom, top, size):
+    """Remove the counts between bottom and top, wrapping around size.
+
+    This behaves like SparseList.wipe_interval, but it visits either the
+    wiped positions or the stored counts, whichever are fewer."""
+    if bottom == top:
+        return
+    if bottom < top:
+        if top - bottom < len(count):
+            for position in range(bottom, top):
+                count.pop(position, None)
+        else:
+            for position in [p for p in count if bottom <= p < top]:
+                del count[position]
+    else:
+        if size - bottom + top < len(count):
+            for position in range(bottom, size):
+                count.pop(position, None)
+            for position in range(top):
+                count.pop(position, None)
+        else:
+            for position in [p for p in count if p >= bottom or p < top]:
+                del count[position]
 
 
 def approximate_matching(records, pattern, stop, k=1):
@@ -151,42 +225,52 @@ def approximate_matching(records, pattern, stop, k=1):
     if records.__len__() == 0 or msize == 0:
         return None
 
+    last = stop+msize-1
+    # Records after last are never considered
+    if records.keys[0] > last:
+        return None
+
     lookup = preprocess_pattern(pattern)
-    count = SparseList(default=0)
+    pattern_size = len(pattern.keys)
+    count = {}
     match_offsets = set()
 
     i = 0
     j = 0   # previous value of i
+    # Local references for the inner loop
+    elements = records.elements
+    get_offsets = lookup.get
+    get_count = count.get
 
     # logging.debug('Starting approximate matching up to %i', stop)
     # Loop only on indexes where there are elements
-    for i in records:
-        if i > stop+msize-1:
+    for i in records.keys:
+        if i > last:
             break
 
         # zero-out the parts that were skipped
-        count.wipe_interval(j % msize, i % msize)
+        if len(count):
+            wipe_counts(count, j % msize, i % msize, msize)
         j = i
 
-        offsets = set(lookup.get(records[i], []))
-        for off in offsets:
-            count[(i + off) % msize] += 1
-            score = count[(i + off) % msize]
+        start = i-msize+1
+        # Offsets of a name are unique, no need for a set
+        for off in get_offsets(elements[i], ()):
+            position = (i + off) % msize
+            score = get_count(position, 0) + 1
+            count[position] = score
             if score == k:
-                match_offsets.add(i+off-msize+1)
+                match_offsets.add(start+off)
             if score > k:
                 k = score
-                match_offsets = set([i+off-msize+1])
+                match_offsets = set([start+off])
 
     if len(match_offsets):
         logging.debug(
-            'Found MATCH in positions {} '
-            'with weight {} ({}%)'.format(
-                match_offsets, k,
-                k * 100.0 / len(pattern.keys)
-            )
+            'Found MATCH in positions %s with weight %s (%s%%)',
+            match_offsets, k, k * 100.0 / pattern_size
         )
-        return [match_offsets, k, float(k) / len(pattern.keys)]
+        return [match_offsets, k, float(k) / pattern_size]
     else:
         # logging.debug('No match found')
         return None
@@ -205,12 +289,73 @@ def makedirs(path):
     return True
 
 
-def recursive_restore(node, part, outputdir, make_dirs=True):
-    """Restore a directory structure starting from a file node."""
-    parent_path = str(
-        part[node.parent].full_path(part) if node.parent is not None
-        else ''
-    )
+def write_pieces(outfile, pieces):
+    """Write many pieces of content, joining them in larger blocks."""
+    buffered = []
+    size = 0
+    for piece in pieces:
+        buffered.append(piece)
+        size += len(piece)
+        if size >= write_block_size:
+            outfile.write(b''.join(buffered))
+            buffered = []
+            size = 0
+    if len(buffered):
+        outfile.write(b''.join(buffered))
+
+
+def _write_node(node, content, restore_path, is_directory):
+    """Write the content of a restored node and set its times."""
+    try:
+        if content is not None:
+            with codecs.open(restore_path, 'wb') as outfile:
+                if isinstance(content, types.GeneratorType):
+                    write_pieces(outfile, content)
+                else:
+                    outfile.write(content)
+        else:
+            if not is_directory:
+                # Empty file, no need for a file object
+                os.close(os.open(
+                    restore_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666
+                ))
+    except IOError:
+        logging.error(u'IOError when trying to create %s', restore_path)
+
+    try:
+        # Restore Modification + Access time
+        mtime, atime, _ = node.get_mac()
+        if mtime is not None:
+            atime = time.mktime(atime.astimezone().timetuple())
+            mtime = time.mktime(mtime.astimezone().timetuple())
+            os.utime(restore_path, (atime, mtime))
+    except IOError:
+        logging.error(u'IOError while setting atime and mtime of %s', restore_path)
+
+
+def recursive_restore(node, part, outputdir, make_dirs=True,
+                      parent_path=None, jobs=None):
+    """Restore a directory structure starting from a file node.
+
+    The path of the parent can be passed to avoid computing it again. Files
+    are written by a pool of threads, jobs is used to share it with the
+    recursive calls. Only a bounded amount of files is kept in flight."""
+    if jobs is None:
+        with ThreadPoolExecutor(restore_threads) as executor:
+            jobs = (executor, deque())
+            recursive_restore(
+                node, part, outputdir, make_dirs, parent_path, jobs
+            )
+            # Propagate unexpected errors of the writers
+            while jobs[1]:
+                jobs[1].popleft().result()
+        return
+
+    if parent_path is None:
+        parent_path = str(
+            part[node.parent].full_path(part) if node.parent is not None
+            else ''
+        )
 
     file_path = os.path.join(parent_path, node.name)
     restore_parent_path = os.path.join(outputdir, parent_path)
@@ -238,35 +383,25 @@ def recursive_restore(node, part, outputdir, make_dirs=True):
         logging.warning(u'Directory %s has data content!', file_path)
         restore_path += '_recuperabit_content'
 
-    try:
-        if content is not None:
-            logging.info(u'Restoring #%s %s', node.index, file_path)
-            with codecs.open(restore_path, 'wb') as outfile:
-                if isinstance(content, types.GeneratorType):
-                    for piece in content:
-                        outfile.write(piece)
-                else:
-                    outfile.write(content)
-        else:
-            if not is_directory:
-                # Empty file
-                open(restore_path, 'wb').close()
-    except IOError:
-        logging.error(u'IOError when trying to create %s', restore_path)
-
-    try:
-        # Restore Modification + Access time
-        mtime, atime, _ = node.get_mac()
-        if mtime is not None:
-            atime = time.mktime(atime.astimezone().timetuple())
-            mtime = time.mktime(mtime.astimezone().timetuple())
-            os.utime(restore_path, (atime, mtime))
-    except IOError:
-        logging.error(u'IOError while setting atime and mtime of %s', restore_path)
+    if content is not None:
+        logging.info(u'Restoring #%s %s', node.index, file_path)
+    if is_directory:
+        _write_node(node, content, restore_path, is_directory)
+    else:
+        executor, futures = jobs
+        futures.append(executor.submit(
+            _write_node, node, content, restore_path, is_directory
+        ))
+        # Wait for the oldest writes, also propagating their errors
+        while len(futures) > restore_pending:
+            futures.popleft().result()
 
     if is_directory:
         for child in node.children:
             if not child.ignore():
-                recursive_restore(child, part, outputdir, make_dirs=False)
+                recursive_restore(
+                    child, part, outputdir, make_dirs=False,
+                    parent_path=file_path, jobs=jobs
+                )
             else:
                 logging.info(u'Skipping ignored file {}'.format(child))
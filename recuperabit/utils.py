@@ -19,40 +19,121 @@
 # along with RecuperaBit. If not, see <http://www.gnu.org/licenses/>.
 
 
+import functools
 import logging
+import mmap
+import os
 import pprint
 import string
-import sys
+import struct
+import threading
 import time
 import unicodedata
+import weakref
 
 from .fs.constants import sector_size
 
 printer = pprint.PrettyPrinter(indent=4)
-all_chars = (chr(i) for i in range(sys.maxunicode))
-unicode_printable = set(
-    c for c in all_chars
-    if not unicodedata.category(c)[0].startswith('C')
-)
 ascii_printable = set(string.printable[:-5])
+image_lock = threading.Lock()
+# Sectors read at once while scanning the image
+feed_block = 8192
+# Consecutive unreadable sectors after which the scan is stopped
+unreadable_limit = 2048
+# Images opened with O_DIRECT and their alignment for offsets and buffers
+direct_images = weakref.WeakSet()
+direct_align = 4096
+
+
+def open_image(path, direct_io=False):
+    """Open a disk image for reading.
+
+    With direct_io the page cache is bypassed, if the platform allows it."""
+    if direct_io:
+        if hasattr(os, 'O_DIRECT') and hasattr(os, 'preadv'):
+            try:
+                image = open(
+                    path, 'rb', buffering=0,
+                    opener=lambda name, flags: os.open(
+                        name, flags | os.O_DIRECT
+                    )
+                )
+            except OSError as err:
+                logging.warning('Cannot use direct I/O: %s', err)
+            else:
+                direct_images.add(image)
+                return image
+        else:
+            logging.warning('Direct I/O is not supported on this platform')
+    return open(path, 'rb')
+
+
+def _direct_pread(fd, length, position):
+    """Read from a descriptor opened with O_DIRECT.
+
+    The read is widened to aligned boundaries and done into a page-aligned
+    buffer, then the requested bytes are extracted."""
+    start = position - position % direct_align
+    end = -(-(position + length) // direct_align) * direct_align
+    if end == start:
+        return b''
+    buffer = mmap.mmap(-1, end - start)
+    try:
+        read = os.preadv(fd, [buffer], start)
+        stop = max(position, min(position + length, start + read))
+        return buffer[position - start:stop - start]
+    finally:
+        buffer.close()
+
+
+def _image_fd(image):
+    """Return the file descriptor of an image, None if it has no one."""
+    if not hasattr(os, 'pread'):
+        return None
+    try:
+        return image.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
 
 
 def sectors(image, offset, size, bsize=sector_size, fill=True):
     """Read from a file descriptor."""
     read = True
-    try:
-        image.seek(offset * bsize)
-    except (IOError, OverflowError, ValueError):
-        read = False
-    if read:
-        try:
-            dump = image.read(size * bsize)
-        except (IOError, MemoryError):
-            logging.warning(
-                "Cannot read sector(s). Filling with 0x00. Offset: {} Size: "
-                "{} Bsize: {}".format(offset, size, bsize)
-            )
+    fd = _image_fd(image) if size >= 0 else None
+    if fd is not None:
+        # Positional reads do not move the file offset, no lock needed
+        if offset < 0:
             read = False
+        else:
+            try:
+                if image in direct_images:
+                    dump = _direct_pread(fd, size * bsize, offset * bsize)
+                else:
+                    dump = os.pread(fd, size * bsize, offset * bsize)
+            except OverflowError:
+                read = False
+            except (IOError, MemoryError):
+                logging.warning(
+                    "Cannot read sector(s). Filling with 0x00. Offset: {} "
+                    "Size: {} Bsize: {}".format(offset, size, bsize)
+                )
+                read = False
+    else:
+        # Seek and read must not be interleaved by other threads
+        with image_lock:
+            try:
+                image.seek(offset * bsize)
+            except (IOError, OverflowError, ValueError):
+                read = False
+            if read:
+                try:
+                    dump = image.read(size * bsize)
+                except (IOError, MemoryError):
+                    logging.warning(
+                        "Cannot read sector(s). Filling with 0x00. Offset: {} "
+                        "Size: {} Bsize: {}".format(offset, size, bsize)
+                    )
+                    read = False
     if not read:
         if fill:
             dump = size * bsize * b'\x00'
@@ -60,6 +141,41 @@ def sectors(image, offset, size, bsize=sector_size, fill=True):
             return None
     return bytearray(dump)
 
+
+def sectors_into(image, out, offset, size, bsize=sector_size):
+    """Read from a file descriptor into a preallocated buffer.
+
+    Return the amount of bytes read, or None if the sectors cannot be read.
+    The buffer must be large enough for all the sectors."""
+    length = size * bsize
+    view = memoryview(out)[:length]
+    fd = _image_fd(image)
+    try:
+        if fd is not None:
+            if offset < 0:
+                return None
+            if image in direct_images:
+                dump = _direct_pread(fd, length, offset * bsize)
+                view[:len(dump)] = dump
+                return len(dump)
+            return os.preadv(fd, [view], offset * bsize)
+        # Seek and read must not be interleaved by other threads
+        with image_lock:
+            image.seek(offset * bsize)
+            return image.readinto(view)
+    except (OverflowError, ValueError):
+        return None
+    except (IOError, MemoryError):
+        logging.warning(
+            "Cannot read sector(s). Offset: {} Size: {} Bsize: {}".format(
+                offset, size, bsize
+            )
+        )
+        return None
+    finally:
+        view.release()
+
+
 def unixtime(dtime):
     """Convert datetime to UNIX epoch."""
     if dtime is None:
@@ -72,9 +188,8 @@ def unixtime(dtime):
 
 # format:
 # [(label, (formatter, lower, higher)), ...]
-def unpack(data, fmt):
-    """Extract formatted information from a string of bytes."""
-    result = {}
+def _unpack_fields(data, fmt, result):
+    """Extract the fields in fmt from data, updating result."""
     for label, description in fmt:
         formatter, lower, higher = description
         # If lower is a function, then apply it
@@ -85,53 +200,312 @@ def unpack(data, fmt):
             result[label] = None
             continue
 
+        chunk = data[low:high+1]
         if callable(formatter):
-            result[label] = formatter(data[low:high+1])
-        else:
-            if formatter == 's':
-                result[label] = str(data[low:high+1])
-            if formatter.startswith('utf'):
-                result[label] = data[low:high+1].decode(formatter)
-            if formatter.endswith('i') and len(formatter) < 4:
-                # Use little-endian by default. Big-endian with >i.
-                # Force sign-extension of first bit with >+i / +i.
-                chunk = data[low:high+1]
-
-                signed = False
-                if '+' in formatter:
-                    signed = True
-
-                byteorder = 'little'
-                if formatter.startswith('>'):
-                    byteorder = 'big'
-
-                if len(chunk):
-                    result[label] = int.from_bytes(chunk, byteorder=byteorder, signed=signed)
-                else:
-                    result[label] = None
+            result[label] = formatter(chunk)
+        elif formatter.endswith('i') and len(formatter) < 4:
+            # Use little-endian by default. Big-endian with >i.
+            # Force sign-extension of first bit with >+i / +i.
+            signed = '+' in formatter
+            byteorder = 'big' if formatter.startswith('>') else 'little'
+
+            if len(chunk):
+                result[label] = int.from_bytes(chunk, byteorder=byteorder, signed=signed)
+            else:
+                result[label] = None
+        elif formatter == 's':
+            result[label] = str(chunk)
+        elif formatter.startswith('utf'):
+            result[label] = chunk.decode(formatter)
     return result
 
 
+# Struct codes for little-endian integers, by formatter and width
+struct_codes = {
+    'i': {1: 'B', 2: 'H', 4: 'I', 8: 'Q'},
+    '+i': {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+}
+# Converters for little-endian integers with other widths
+odd_width_converters = {
+    'i': lambda chunk: int.from_bytes(chunk, byteorder='little'),
+    '+i': lambda chunk: int.from_bytes(
+        chunk, byteorder='little', signed=True
+    )
+}
+# Precompiled formats, by id of the format list
+compiled_formats = {}
+
+
+def _compile_field(formatter, lower, higher):
+    """Return a function extracting a field like _unpack_fields does.
+
+    The function takes the data and the partial result and returns the
+    value of the field."""
+    if callable(formatter):
+        extract = formatter
+    elif formatter == 's':
+        extract = str
+    elif formatter.startswith('utf'):
+        def extract(chunk):
+            return chunk.decode(formatter)
+    elif formatter.endswith('i') and len(formatter) < 4:
+        signed = '+' in formatter
+        byteorder = 'big' if formatter.startswith('>') else 'little'
+
+        def extract(chunk):
+            if not len(chunk):
+                return None
+            return int.from_bytes(chunk, byteorder=byteorder, signed=signed)
+    else:
+        def extract(chunk):
+            return None
+
+    if not callable(lower) and not callable(higher):
+        if lower is None or higher is None:
+            return lambda data, result: None
+        return lambda data, result: extract(data[lower:higher+1])
+
+    def bound(limit):
+        return limit if callable(limit) else lambda result: limit
+    get_lower, get_higher = bound(lower), bound(higher)
+
+    def getter(data, result):
+        low = get_lower(result)
+        high = get_higher(result)
+        if low is None or high is None:
+            return None
+        return extract(data[low:high+1])
+    return getter
+
+
+def precompile(fmt, converters=None):
+    """Prepare a struct for the fixed integer fields of a format.
+
+    The optional converters map a formatter function to a struct code and to
+    a function applied to the unpacked integer, so that these fields can be
+    read with the others. The remaining fields are extracted one by one by
+    functions prepared here. The format list must not be modified after it
+    has been precompiled."""
+    if converters is None:
+        converters = {}
+    fixed = []
+    for label, (formatter, lower, higher) in fmt:
+        if not isinstance(lower, int) or not isinstance(higher, int):
+            continue
+        width = higher - lower + 1
+        convert = None
+        if formatter in struct_codes:
+            code = struct_codes[formatter].get(width)
+            # Odd widths are read as bytes and converted
+            if code is None and width > 0:
+                code = '%ds' % width
+                convert = odd_width_converters[formatter]
+        elif callable(formatter) and formatter in converters:
+            code, convert = converters[formatter]
+            if struct.calcsize('<' + code) != width:
+                code = None
+        else:
+            code = None
+        if code is not None:
+            fixed.append((lower, higher, label, code, convert))
+    fixed.sort(key=lambda field: field[:2])
+
+    layout = ['<']
+    names = []
+    converted = []
+    position = 0
+    for lower, higher, label, code, convert in fixed:
+        # Overlapping fields are left to the generic path
+        if lower < position:
+            continue
+        if lower > position:
+            layout.append('%dx' % (lower - position))
+        layout.append(code)
+        if convert is not None:
+            converted.append((len(names), convert))
+        names.append(label)
+        position = higher + 1
+
+    rest = [
+        (label, _compile_field(*description))
+        for label, description in fmt if label not in names
+    ]
+    labels = [label for label, _ in fmt]
+    compiled_formats[id(fmt)] = (
+        fmt, struct.Struct(''.join(layout)), names, converted, labels, rest
+    )
+    return fmt
+
+
+def unpack(data, fmt, offset=0):
+    """Extract formatted information from a string of bytes.
+
+    Fields are relative to the given offset inside data."""
+    compiled = compiled_formats.get(id(fmt))
+    if compiled is not None and compiled[0] is fmt:
+        _, layout, names, converted, labels, rest = compiled
+        # Short buffers may hold truncated fields, use the generic path
+        if len(data) - offset >= layout.size:
+            values = layout.unpack_from(data, offset)
+            if len(converted):
+                values = list(values)
+                for position, convert in converted:
+                    values[position] = convert(values[position])
+            if not len(rest):
+                return dict(zip(names, values))
+            # Keep the same key order of the format
+            result = dict.fromkeys(labels)
+            result.update(zip(names, values))
+            if offset:
+                data = data[offset:]
+            for label, getter in rest:
+                result[label] = getter(data, result)
+            return result
+    if offset:
+        data = data[offset:]
+    return _unpack_fields(data, fmt, {})
+
+
+def _advise_sequential(image):
+    """Tell the kernel that the image will be read sequentially."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(image.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+
+def _feed_run(scanners, first, chunk):
+    """Feed consecutive sectors to the scanners.
+
+    Return the tuples (index, result) in the same order as feeding the
+    sectors one by one to all the scanners."""
+    found = []
+    for instance in scanners:
+        feed_bulk = getattr(instance, 'feed_bulk', None)
+        if feed_bulk is not None:
+            found.extend(feed_bulk(first, chunk))
+            continue
+        for position in range(0, len(chunk), sector_size):
+            index = first + position // sector_size
+            res = instance.feed(index, chunk[position:position+sector_size])
+            if res is not None:
+                found.append((index, res))
+    # The sort is stable, scanners keep their order within a sector
+    found.sort(key=lambda item: item[0])
+    return found
+
+
 def feed_all(image, scanners, indexes):
     # Scan the disk image and feed the scanners
+    _advise_sequential(image)
+    if isinstance(indexes, (list, tuple, set, frozenset)):
+        # Read finite collections in order and only once
+        indexes = sorted(set(indexes))
     interesting = []
-    for index in indexes:
-        sector = sectors(image, index, 1, fill=False)
-        if not sector:
-            break
+    # The same buffer is reused for all the reads
+    buffer = bytearray(feed_block * sector_size)
+    length = 0      # valid bytes in buffer
+    first = None    # index of the first sector in buffer
+    previous = None
+    run = None      # first index of the sectors in buffer not fed yet
+    unreadable = 0
+    first_unreadable = None
+    consecutive = 0     # unreadable sectors since the last good read
+    careful_until = 0   # read one sector at a time before this one
+
+    def feed_run():
+        chunk = buffer[
+            (run - first) * sector_size:
+            min((previous + 1 - first) * sector_size, length)
+        ]
+        for index, res in _feed_run(scanners, run, chunk):
+            logging.info('Found %s at sector %s', res, index)
+            interesting.append(index)
 
-        for instance in scanners:
-            res = instance.feed(index, sector)
-            if res is not None:
-                logging.info('Found {} at sector {}'.format(res, index))
-                interesting.append(index)
+    for index in indexes:
+        if first is not None:
+            start = (index - first) * sector_size
+            # Consecutive sectors in the buffer are fed together
+            if (run is not None and index == previous + 1 and
+                    start < length):
+                previous = index
+                continue
+        if run is not None:
+            feed_run()
+            run = None
+        if first is None or not 0 <= start < length:
+            # Read many sectors at once only while scanning sequentially
+            sequential = previous is not None and index == previous + 1
+            if sequential and index >= careful_until:
+                size = feed_block
+            else:
+                size = 1
+            length = sectors_into(image, buffer, index, size)
+            if length is None and size > 1:
+                # Some sector in the block is bad, find it
+                careful_until = index + size
+                length = sectors_into(image, buffer, index, 1)
+            if length is None:
+                # Bad sector, go on with the following ones
+                unreadable += 1
+                consecutive += 1
+                if first_unreadable is None:
+                    first_unreadable = index
+                if consecutive >= unreadable_limit:
+                    # The image is gone or it cannot be read at all
+                    logging.error(
+                        'Stopping the scan after %d unreadable sectors '
+                        'in a row, the last one is %d', consecutive, index
+                    )
+                    break
+                first = None
+                previous = index
+                continue
+            if not length:
+                # End of the image
+                break
+            consecutive = 0
+            first = index
+        run = index
+        previous = index
+    if run is not None:
+        feed_run()
+    if unreadable:
+        logging.warning(
+            'Skipped %d unreadable sectors, the first one is %d',
+            unreadable, first_unreadable
+        )
     return interesting
 
 
+class _PrintableTable(dict):
+    """Translation table for printable, filled when characters are met."""
+    def __init__(self, default):
+        super().__init__()
+        self.default = default
+
+    def __missing__(self, code):
+        char = chr(code)
+        # Control, format, surrogate, private and unassigned are replaced
+        if unicodedata.category(char)[0] == 'C':
+            char = self.default
+        self[code] = char
+        return char
+
+
+# Translation tables for printable, by default character
+printable_tables = {}
+
+
 def printable(text, default='.', alphabet=None):
     """Replace unprintable characters in a text with a default one."""
     if alphabet is None:
-        alphabet = unicode_printable
+        table = printable_tables.get(default)
+        if table is None:
+            table = printable_tables[default] = _PrintableTable(default)
+        return text.translate(table)
     return ''.join((i if i in alphabet else default) for i in text)
 
 def pretty(dictionary):
@@ -159,7 +533,8 @@ def readable_bytes(amount):
     powers = {
         0: '', 1: 'K', 2: 'M', 3: 'G', 4: 'T'
     }
-    biggest = max(i for i in powers if amount / 1024.**i >= 1)
+    # Each power of 1024 adds 10 bits, values are at least 1 here
+    biggest = min(4, (int(amount).bit_length() - 1) // 10)
     scaled = amount / 1024.**biggest
     return '%.2f %sB' % (scaled, powers[biggest])
 
@@ -188,23 +563,21 @@ def _file_tree_repr(node):
     )
 
 
+def tree_folder_lines(directory, padding=0):
+    """Yield the lines of a tree-like representation of a directory."""
+    # Explicit stack, deep trees would exceed the recursion limit
+    stack = [(directory, padding)]
+    while len(stack):
+        node, padding = stack.pop()
+        yield ' ' * padding + _file_tree_repr(node)
+        stack.extend(
+            (entry, padding + 2) for entry in reversed(node.sorted_children())
+        )
+
+
 def tree_folder(directory, padding=0):
     """Return a tree-like textual representation of a directory."""
-    lines = []
-    pad = ' ' * padding
-    lines.append(
-        pad + _file_tree_repr(directory)
-    )
-    padding = padding + 2
-    pad = ' ' * padding
-    for entry in directory.children:
-        if len(entry.children) or entry.is_directory:
-            lines.append(tree_folder(entry, padding))
-        else:
-            lines.append(
-                pad + _file_tree_repr(entry)
-            )
-    return '\n'.join(lines)
+    return '\n'.join(tree_folder_lines(directory, padding))
 
 
 def _bodyfile_repr(node, path):
@@ -229,16 +602,16 @@ def bodyfile_folder(directory, path=''):
     Format:
     '#MD5|name|inode|mode_as_string|UID|GID|size|atime|mtime|ctime|crtime'
     See also: http://wiki.sleuthkit.org/index.php?title=Body_file"""
-    lines = [_bodyfile_repr(directory, path)]
-    path += directory.name + '/'
-    for entry in directory.children:
-        if len(entry.children) or entry.is_directory:
-            lines += bodyfile_folder(entry, path)
-        else:
-            lines.append(_bodyfile_repr(entry, path))
-    return lines
+    stack = [(directory, path)]
+    while len(stack):
+        node, path = stack.pop()
+        yield _bodyfile_repr(node, path)
+        path += node.name + '/'
+        stack.extend((entry, path) for entry in reversed(node.sorted_children()))
 
 
+# Labels repeat across multiple exports of the same partition
+@functools.lru_cache(maxsize=2**16, typed=True)
 def _ltx_clean(label):
     """Small filter to prepare strings to be included in LaTeX code."""
     clean = str(label).replace('$', r'\$').replace('_', r'\_')
@@ -257,17 +630,26 @@ def _tikz_repr(node):
 
 def tikz_child(directory, padding=0):
     """Write a child row for Tikz representation."""
-    pad = ' ' * padding
-    lines = [r'%schild {%s' % (pad, _tikz_repr(directory))]
-    count = len(directory.children)
-    for entry in directory.children:
-        content, number = tikz_child(entry, padding+4)
-        lines.append(content)
-        count += number
-    lines.append('}')
-    for entry in range(count):
-        lines.append('child [missing] {}')
-    return '\n'.join(lines).replace('\n}', '}'), count
+    lines = []
+    # Missing rows of the nodes being visited, innermost last
+    counts = [0]
+    stack = [(directory, padding)]
+    while len(stack):
+        node, padding = stack.pop()
+        if node is None:
+            # All the children of the innermost node were written
+            count = counts.pop()
+            lines[-1] += '}'
+            lines.extend(['child [missing] {}'] * count)
+            counts[-1] += count
+            continue
+        lines.append(r'%schild {%s' % (' ' * padding, _tikz_repr(node)))
+        counts.append(len(node.children))
+        stack.append((None, None))
+        stack.extend(
+            (entry, padding + 4) for entry in reversed(node.sorted_children())
+        )
+    return '\n'.join(lines), counts[0]
 
 
 def tikz_part(part):
@@ -297,42 +679,48 @@ def tikz_part(part):
 
 
 def csv_part(part):
-    """Provide a CSV representation for a partition."""
-    contents = [
-        ','.join(('Id', 'Parent', 'Name', 'Full Path', 'Modification Time',
-                  'Access Time', 'Creation Time', 'Size (bytes)',
-                  'Size (human)', 'Offset (bytes)', 'Offset (sectors)',
-                  'Directory', 'Deleted', 'Ghost'))
-    ]
-    for index in part.files:
-        obj = part.files[index]
-        contents.append(
-                u'%s,%s,"%s","%s",%s,%s,%s,%s,%s,%s,%s,%s,%s,%s' % (
-                    obj.index, obj.parent, obj.name,
-                    obj.full_path(part),
-                    obj.mac['modification'], obj.mac['access'],
-                    obj.mac['creation'], obj.size,
-                    readable_bytes(obj.size),
-                    (obj.offset * sector_size
-                     if obj.offset is not None else None),
-                    obj.offset,
-                    '1' if obj.is_directory else '',
-                    '1' if obj.is_deleted else '',
-                    '1' if obj.is_ghost else ''
-                )
+    """Provide a CSV representation for a partition, one line at a time."""
+    yield ','.join(('Id', 'Parent', 'Name', 'Full Path', 'Modification Time',
+                    'Access Time', 'Creation Time', 'Size (bytes)',
+                    'Size (human)', 'Offset (bytes)', 'Offset (sectors)',
+                    'Directory', 'Deleted', 'Ghost'))
+    for obj in part.files.values():
+        yield u'%s,%s,"%s","%s",%s,%s,%s,%s,%s,%s,%s,%s,%s,%s' % (
+            obj.index, obj.parent, obj.name,
+            obj.full_path(part),
+            obj.mac['modification'], obj.mac['access'],
+            obj.mac['creation'], obj.size,
+            readable_bytes(obj.size),
+            (obj.offset * sector_size
+             if obj.offset is not None else None),
+            obj.offset,
+            '1' if obj.is_directory else '',
+            '1' if obj.is_deleted else '',
+            '1' if obj.is_ghost else ''
         )
-    return contents
+
+
+def write_lines(outfile, lines):
+    """Write lines separated by newlines without joining all of them."""
+    lines = iter(lines)
+    for line in lines:
+        outfile.write(line)
+        break
+    for line in lines:
+        outfile.write('\n')
+        outfile.write(line)
 
 
 def _sub_locate(text, directory, part):
     """Helper for locate."""
     lines = []
-    for entry in sorted(directory.children, key=lambda node: node.name):
+    stack = list(reversed(directory.sorted_children()))
+    while len(stack):
+        entry = stack.pop()
         path = entry.full_path(part)
         if text in path.lower():
             lines.append((entry, path))
-        if len(entry.children) or entry.is_directory:
-            lines += _sub_locate(text, entry, part)
+        stack.extend(reversed(entry.sorted_children()))
     return lines
 
 
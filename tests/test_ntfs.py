@@ -0,0 +1,125 @@
+"""Tests for the NTFS reconstruction."""
+
+# RecuperaBit
+# Copyright 2014-2021 Andrea Lazzarotto
+#
+# This file is part of RecuperaBit.
+#
+# RecuperaBit is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# RecuperaBit is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with RecuperaBit. If not, see <http://www.gnu.org/licenses/>.
+
+
+import copy
+import io
+import unittest
+from unittest import mock
+
+from recuperabit.fs import ntfs
+from recuperabit.fs.ntfs import FILE_size, NTFSFile, NTFSPartition, NTFSScanner
+
+
+def file_name(name, parent):
+    """Return a parsed $FILE_NAME attribute."""
+    return {'content': {
+        'parent_entry': parent, 'name_length': len(name), 'name': name,
+        'namespace': 1, 'modification_time': None, 'access_time': None,
+        'creation_time': None
+    }}
+
+
+class FinalizeReconstructionTest(unittest.TestCase):
+    """A directory whose $INDEX_ALLOCATION is in an extension record."""
+
+    mft_pos = 100
+    indx_pos = 80
+
+    def setUp(self):
+        self.image = io.BytesIO(bytes(512 * 256))
+        self.scanner = NTFSScanner(self.image)
+        self.part = NTFSPartition(self.scanner, self.mft_pos)
+        self.part.offset = 0
+        self.part.sec_per_clus = 8
+
+        self.base_offset = self.mft_pos + 40 * FILE_size
+        self.base = {
+            'record_n': 40, 'flags': 0x3, 'base_record': 0, 'valid': True,
+            'attributes': {
+                '$FILE_NAME': [file_name('big', 5)],
+                '$ATTRIBUTE_LIST': {'content': {'entries': [
+                    {'type': 48, 'file_ref': 40},
+                    {'type': 160, 'file_ref': 41}
+                ]}}
+            }
+        }
+        self.extension = {
+            'record_n': 41, 'flags': 0x1, 'base_record': 40, 'valid': True,
+            'attributes': {
+                '$INDEX_ALLOCATION': [{
+                    'name': '$I30',
+                    'runlist': [{'length': 1, 'offset': 10}]
+                }]
+            }
+        }
+        self.scanner.parsed_file_review[self.base_offset] = self.base
+        self.scanner.parsed_indx[self.indx_pos] = {
+            'parent': 40, 'children': set([50, 51])
+        }
+        self.part.add_file(NTFSFile(self.base, self.base_offset))
+
+        indx_entries = [
+            {'record_n': n, '$FILE_NAME': file_name(name, 40)['content']}
+            for n, name in ((50, 'first'), (51, 'second'))
+        ]
+        patches = (
+            mock.patch.object(
+                ntfs, 'parse_file_record',
+                side_effect=lambda dump: self.extension
+            ),
+            mock.patch.object(
+                ntfs, 'parse_indx_record',
+                side_effect=lambda dump: {'entries': [
+                    dict(entry) for entry in indx_entries
+                ]}
+            )
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_ghost_children_from_extension_record(self):
+        added = self.scanner.finalize_reconstruction(self.part)
+        self.assertEqual(set(added), set([50, 51]))
+        for index, name in ((50, 'first'), (51, 'second')):
+            node = self.part.files[index]
+            self.assertTrue(node.is_ghost)
+            self.assertEqual(node.name, name)
+            self.assertEqual(node.parent, 40)
+
+    def test_saved_record_is_not_modified(self):
+        self.scanner.finalize_reconstruction(self.part)
+        self.assertEqual(
+            set(self.base['attributes']), set(['$FILE_NAME', '$ATTRIBUTE_LIST'])
+        )
+
+    def test_cached_record_is_not_modified(self):
+        position = self.mft_pos + 41 * FILE_size
+        cached = ntfs._read_record(self.image, position)
+        snapshot = copy.deepcopy(cached)
+        for _ in range(2):
+            self.scanner.finalize_reconstruction(self.part)
+        self.assertIs(ntfs._read_record(self.image, position), cached)
+        self.assertEqual(cached, snapshot)
+
+
+if __name__ == '__main__':
+    unittest.main()